@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import numpy as np
 import sys
 import time
 import pytest
 import torch
-from ncps.torch import CfC, LTCCell, LTC
+from copy import deepcopy
+from ncps.torch import CfC, CfCCell, LTCCell, LTC, StackedCfCCell, WiredCfCCell
 import ncps
 
 
@@ -174,6 +176,395 @@ def test_ncp_cfc_2():
     # ):
 
 
+def test_cfc_track_tau_system():
+    rnn = CfC(8, 16, mode="pure", track_tau_system=True)
+    input = torch.randn(2, 3, 8)
+    output, hx, tau = rnn(input)
+    assert output.size() == (2, 3, 16)
+    assert len(tau) == 3
+    assert not CfC(8, 16, mode="pure").rnn_cell.record_tau_system
+
+
+def test_cfc_cell_init_bound():
+    # Each gate block keeps the Xavier bound of a separate (H, in + H) layer
+    input_size = 8
+    hidden_size = 16
+    bound = np.sqrt(6 / (input_size + 2 * hidden_size))
+    cell = CfCCell(input_size, hidden_size, backbone_layers=0)
+    stacked = StackedCfCCell(2, input_size, hidden_size, backbone_layers=0)
+    blocks = list(cell.ff.weight.detach().view(4, hidden_size, -1)) + list(
+        stacked.ff_weight.detach().view(8, hidden_size, -1)
+    )
+    for block in blocks:
+        assert block.abs().max() <= bound
+        assert block.abs().max() > 0.9 * bound
+
+
+def test_cfc_cell_legacy_state_dict():
+    cell = CfCCell(8, 16, backbone_layers=0)
+    legacy = {k: v for k, v in cell.state_dict().items() if not k.startswith("ff.")}
+    weights = cell.ff.weight.detach().chunk(4, 0)
+    biases = cell.ff.bias.detach().chunk(4, 0)
+    for name, w, b in zip(("ff1", "ff2", "time_a", "time_b"), weights, biases):
+        legacy[name + ".weight"] = w.clone()
+        legacy[name + ".bias"] = b.clone()
+    restored = CfCCell(8, 16, backbone_layers=0)
+    restored.load_state_dict(legacy)
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    assert torch.allclose(cell(input, hx, 1.0)[0], restored(input, hx, 1.0)[0])
+
+
+def test_cfc_cell_sparse_inference():
+    input_size = 8
+    hidden_size = 32
+    mask = np.random.rand(input_size + hidden_size, hidden_size) < 0.05
+    input = torch.randn(3, input_size)
+    hx = torch.randn(3, hidden_size)
+    for mode in ("pure", "default"):
+        cell = CfCCell(
+            input_size, hidden_size, mode, backbone_layers=0, sparsity_mask=mask
+        )
+        assert cell._ff_mask_density < 0.1
+        with torch.no_grad():
+            cell.sparse_density_threshold = 0.0
+            cell.scatter_density_threshold = 0.0
+            dense, _ = cell(input, hx, 1.0)
+            cell.scatter_density_threshold = 1.0
+            scattered, _ = cell(input, hx, 1.0)
+            cell.sparse_density_threshold = 1.0
+            sparse, _ = cell(input, hx, 1.0)
+        assert torch.allclose(dense, scattered, atol=1e-6)
+        assert torch.allclose(dense, sparse, atol=1e-6)
+
+
+def test_cfc_cell_teacher_forced_step():
+    cell = CfCCell(8, 16, "pure")
+    input = torch.randn(2, 5, 8)
+    hx = torch.randn(2, 5, 16)
+    ts = torch.rand(2, 5)
+    out = cell.teacher_forced_step(input, hx, ts)
+    assert out.size() == (2, 5, 16)
+    assert out.dtype == hx.dtype
+    step, _ = cell(input[:, 3], hx[:, 3], ts[:, 3:4])
+    assert torch.allclose(out[:, 3], step, atol=1e-6)
+
+
+def test_cfc_cell_quantize_for_inference():
+    cell = CfCCell(8, 16)
+    input = torch.randn(3, 8)
+    hx = torch.zeros(3, 16)
+    with torch.no_grad():
+        expected, _ = cell(input, hx, 1.0)
+        cell.quantize_for_inference()
+        output, _ = cell(input, hx, 1.0)
+    assert output.size() == (3, 16)
+    assert torch.allclose(output, expected, atol=0.1)
+
+
+def test_stacked_cfc_cell():
+    stacked = StackedCfCCell(3, 8, 16, backbone_units=32)
+    input = torch.randn(3, 2, 8)
+    hx = torch.randn(3, 2, 16)
+    output, hx_new = stacked(input, hx, 1.0)
+    assert output.size() == (3, 2, 16)
+
+    cell = CfCCell(8, 16, backbone_units=32)
+    with torch.no_grad():
+        cell.backbone[0].weight.copy_(stacked.backbone_weight[0][1])
+        cell.backbone[0].bias.copy_(stacked.backbone_bias[0][1])
+        cell.ff.weight.copy_(stacked.ff_weight[1])
+        cell.ff.bias.copy_(stacked.ff_bias[1])
+    expected, _ = cell(input[1], hx[1], 1.0)
+    assert torch.allclose(output[1], expected, atol=1e-5)
+
+
+def test_cfc_cell_padded_hidden():
+    padded = CfCCell(8, 13, pad_hidden_to=8)
+    assert padded.ff.weight.size(0) == 4 * 16
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 13)
+    output, _ = padded(input, hx, 1.0)
+    assert output.size() == (3, 13)
+    assert output.is_contiguous()
+    blocks = padded.ff.weight.detach().view(4, 16, -1)
+    assert torch.all(blocks[:, 13:] == 0)
+    assert torch.all(padded.ff.bias.detach().view(4, 16)[:, 13:] == 0)
+    # Same Xavier bound as the (13, in + 13) blocks of an unpadded cell
+    bound = np.sqrt(6 / (padded.ff.in_features + 13))
+    assert blocks[:, :13].abs().max() <= bound
+
+    with pytest.raises(ValueError):
+        CfCCell(8, 13, pad_hidden_to=0)
+
+    neuromodulated = CfCCell(8, 13, "neuromodulated", pad_hidden_to=8)
+    # 0-dim, per-unit and per-sample signals
+    for signal in (torch.tensor(0.5), torch.rand(13), torch.rand(3, 1)):
+        state, _ = neuromodulated(input, hx, 1.0, signal)
+        assert state.size() == (3, 13)
+
+    cell = CfCCell(8, 13)
+    with torch.no_grad():
+        cell.backbone[0].weight.copy_(padded.backbone[0].weight)
+        cell.backbone[0].bias.copy_(padded.backbone[0].bias)
+        cell.ff.weight.copy_(padded.ff.weight.view(4, 16, -1)[:, :13].reshape(52, -1))
+        cell.ff.bias.copy_(padded.ff.bias.view(4, 16)[:, :13].reshape(52))
+    expected, _ = cell(input, hx, 1.0)
+    assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_cfc_cell_fuse_for_inference():
+    cell = CfCCell(8, 16, backbone_layers=2)
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    with pytest.raises(ValueError):
+        cell.fuse_for_inference()
+    cell.backbone[3] = torch.nn.Identity()
+    with torch.no_grad():
+        expected, _ = cell(input, hx, 1.0)
+        cell.fuse_for_inference()
+        output, _ = cell(input, hx, 1.0)
+    assert len(cell.backbone) == 2
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_cfc_cell_load_sparsity_mask():
+    input_size = 8
+    hidden_size = 16
+    masks = [
+        np.random.rand(input_size + hidden_size, hidden_size) < 0.15 for _ in range(2)
+    ]
+    input = torch.randn(3, input_size)
+    hx = torch.randn(3, hidden_size)
+    for mode in ("default", "pure"):
+        kwargs = dict(backbone_layers=0)
+        source = CfCCell(input_size, hidden_size, mode, sparsity_mask=masks[0], **kwargs)
+        target = CfCCell(input_size, hidden_size, mode, sparsity_mask=masks[1], **kwargs)
+        target.load_state_dict(source.state_dict())
+        for threshold in (0.0, 1.0):
+            source.scatter_density_threshold = threshold
+            target.scatter_density_threshold = threshold
+            expected, _ = source(input, hx, 1.0)
+            output, _ = target(input, hx, 1.0)
+            assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_cfc_cell_masked_weight_cache():
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    # Dense, scatter-add and CSR inference paths
+    for density in (0.5, 0.15, 0.05):
+        mask = np.random.rand(8 + 16, 16) < density
+        cell = CfCCell(8, 16, backbone_layers=0, sparsity_mask=mask)
+        optimizer = torch.optim.SGD(cell.parameters(), lr=0.1)
+        with torch.no_grad():
+            before, _ = cell(input, hx, 1.0)
+        if cell._ff_mask_density < cell.scatter_density_threshold:
+            # Sparse masks do not keep a dense copy of the weight
+            assert cell._ff_masked_weight is None
+            assert cell._ff_masked_values.numel() == len(cell._ff_rows)
+
+        cell(input, hx, 1.0)[0].sum().backward()
+        optimizer.step()
+        with torch.no_grad():
+            after_step, _ = cell(input, hx, 1.0)
+        assert not torch.allclose(before, after_step)
+
+        cell.ff.weight.data.copy_(torch.randn_like(cell.ff.weight))
+        cell.refresh_masked_weights()
+        with torch.no_grad():
+            after_copy, _ = cell(input, hx, 1.0)
+        assert not torch.allclose(after_step, after_copy)
+        expected, _ = cell(input, hx, 1.0)
+        assert torch.allclose(after_copy, expected.detach(), atol=1e-6)
+
+
+def test_cfc_cell_legacy_tau_system():
+    cell = CfCCell(8, 16, "pure")
+    legacy = dict(cell.state_dict())
+    legacy["tau_system"] = torch.ones(16)
+    restored = CfCCell(8, 16, "pure")
+    restored.load_state_dict(legacy)
+    restored.record_tau_system = True
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    restored(input, hx, 1.0)
+    tau = restored.last_tau_system
+    restored(torch.randn(5, 8), torch.randn(5, 16), 1.0)
+    assert tau.size() == (3, 16)
+    assert torch.allclose(cell(input, hx, 1.0)[0], restored(input, hx, 1.0)[0])
+
+
+def test_cfc_cell_compile():
+    if not hasattr(torch, "compile"):
+        pytest.skip("torch.compile is not available")
+    import torch._dynamo
+    import torch._inductor.exc
+
+    if not getattr(torch._dynamo, "is_dynamo_supported", lambda: True)():
+        pytest.skip("torch.compile is not supported on this Python version")
+
+    # Only a missing or broken C++ toolchain for the inductor backend skips
+    # the test, graph breaks under fullgraph=True still fail it
+    backend_errors = tuple(
+        error
+        for error in (
+            getattr(torch._dynamo.exc, "BackendCompilerFailed", None),
+            getattr(torch._inductor.exc, "InvalidCxxCompiler", None),
+            getattr(torch._inductor.exc, "CppCompileError", None),
+        )
+        if error is not None
+    )
+    cell = CfCCell(8, 16)
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    with torch.no_grad():
+        expected, _ = cell(input, hx, 1.0)
+        cell.use_compile = True
+        try:
+            output, _ = cell(input, hx, 1.0)
+        except backend_errors as e:
+            pytest.skip(f"No working compiler backend: {e}")
+        assert torch.allclose(output, expected, atol=1e-5)
+
+        # Copies must run their own weights rather than the original's
+        copy = deepcopy(cell)
+        assert copy._compiled is None
+        copy.ff.bias.add_(1.0)
+        copied, _ = copy(input, hx, 1.0)
+        assert not torch.allclose(copied, expected)
+        buffer = io.BytesIO()
+        torch.save(cell, buffer)
+
+        cell.quantize_for_inference()
+        assert cell._compiled is None
+        cell.use_compile = False
+        quantized, _ = cell(input, hx, 1.0)
+    assert torch.allclose(quantized, expected, atol=0.1)
+
+
+def test_cfc_cell_cpu_autocast():
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    for mode in ("default", "pure"):
+        cell = CfCCell(8, 16, mode)
+        with torch.no_grad():
+            expected, _ = cell(input, hx, 1.0)
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                output, state = cell(input, hx, 1.0)
+        assert state.dtype == hx.dtype
+        assert torch.allclose(output, expected, atol=5e-2)
+
+
+def test_cfc_cell_scratch_buffers():
+    for mode in ("default", "pure"):
+        cell = CfCCell(8, 16, mode)
+        steps = []
+        with torch.no_grad():
+            for batch_size in (5, 2, 7):
+                input = torch.randn(batch_size, 8)
+                hx = torch.randn(batch_size, 16)
+                output, _ = cell(input, hx, 1.0)
+                steps.append((input, hx, output, output.clone()))
+        for input, hx, output, copy in steps:
+            # Later steps must not overwrite earlier outputs
+            assert torch.equal(output, copy)
+            expected, _ = cell(input, hx, 1.0)
+            assert torch.allclose(output, expected.detach(), atol=1e-6)
+
+        with torch.inference_mode():
+            output, _ = cell(input, hx, 1.0)
+        assert torch.allclose(output, expected.detach(), atol=1e-6)
+        with torch.no_grad():
+            output, _ = cell(input, hx, 1.0)
+        assert torch.allclose(output, expected.detach(), atol=1e-6)
+
+        cell.double()
+        with torch.no_grad():
+            output, _ = cell(input.double(), hx.double(), 1.0)
+        assert output.dtype == torch.float64
+        assert torch.allclose(output.float(), expected.detach(), atol=1e-5)
+
+        with pytest.raises(RuntimeError):
+            with torch.no_grad():
+                cell(torch.randn(3, 8).double(), torch.randn(1, 16).double(), 1.0)
+
+
+def test_cfc_cell_scalar_time_span():
+    cell = CfCCell(8, 16, "pure")
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    output, _ = cell(input, hx, 0.5)
+    ts = cell._ts_tensor
+    cell(input, hx, 0.5)
+    assert cell._ts_tensor is ts
+    expected, _ = cell(input, hx, torch.full((3, 1), 0.5))
+    assert torch.allclose(output, expected)
+    # A new value must not reuse the cached tensor
+    output, _ = cell(input, hx, 2.0)
+    expected, _ = cell(input, hx, torch.full((3, 1), 2.0))
+    assert torch.allclose(output, expected)
+
+
+def test_cfc_cell_neuromodulated():
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    ts = 0.7
+    for mode in ("neuromodulated", "only_neuromodulated"):
+        cell = CfCCell(8, 16, mode)
+        cell.record_tau_system = True
+        with pytest.raises(AssertionError):
+            cell(input, hx, ts)
+        with torch.no_grad():
+            ff1 = cell.ff1(cell.backbone(torch.cat([input, hx], 1)))
+            for signal in (torch.rand(3, 16), torch.rand(3, 1)):
+                denom = signal.abs()
+                if mode == "neuromodulated":
+                    denom = denom + cell.w_tau.abs()
+                expected = -cell.A * torch.exp(-ts * denom) * ff1 + cell.A
+                output, _ = cell(input, hx, ts, signal)
+                assert torch.allclose(output, expected, atol=1e-6)
+                assert torch.allclose(cell.last_tau_system, 1.0 / denom)
+
+
+def test_wired_cfc_cell_legacy_sparsity_mask():
+    cell = WiredCfCCell(8, ncps.wirings.AutoNCP(16, 4))
+    legacy = {}
+    for i, layer in enumerate(cell._layers):
+        assert layer.sparsity_mask.dtype == torch.bool
+        assert "sparsity_mask" not in dict(layer.named_parameters())
+        assert "sparsity_mask" in dict(layer.named_buffers())
+        # Checkpoints from before the change store the mask as a float
+        # Parameter, the gates as separate layers and tau_system
+        prefix = f"layer_{i}."
+        for key, value in layer.state_dict().items():
+            if key == "sparsity_mask":
+                legacy[prefix + key] = value.float()
+            elif key.startswith("ff."):
+                suffix = key[len("ff.") :]
+                for name, chunk in zip(
+                    ("ff1", "ff2", "time_a", "time_b"), value.chunk(4, 0)
+                ):
+                    legacy[f"{prefix}{name}.{suffix}"] = chunk.clone()
+            else:
+                legacy[prefix + key] = value
+        legacy[prefix + "tau_system"] = torch.ones(layer.hidden_size)
+
+    restored = WiredCfCCell(8, ncps.wirings.AutoNCP(16, 4))
+    restored.load_state_dict(legacy)
+    for layer in restored._layers:
+        assert layer.sparsity_mask.dtype == torch.bool
+    input = torch.randn(3, 8)
+    hx = torch.randn(3, 16)
+    expected, expected_state = cell(input, hx, 1.0)
+    output, state = restored(input, hx, 1.0)
+    assert torch.allclose(output, expected, atol=1e-6)
+    assert torch.allclose(state, expected_state, atol=1e-6)
+    with torch.no_grad():
+        output, _ = restored(input, hx, 1.0)
+    assert torch.allclose(output, expected.detach(), atol=1e-6)
+
+
 if __name__ == "__main__":
     import traceback
     import warnings
@@ -104,6 +104,7 @@ class CfC(nn.Module):
                 backbone_layers,
                 backbone_dropout,
             )
+            self.rnn_cell.record_tau_system = track_tau_system
         self.use_mixed = mixed_memory
         if self.use_mixed:
             self.lstm = LSTMCell(input_size, self.state_size)
@@ -185,7 +186,7 @@ class CfC(nn.Module):
             h_out, h_state = self.rnn_cell.forward(inputs, h_state, ts, neuromod_signal)
 
             if self.track_tau_system:
-                tau_tracker.append(self.rnn_cell.tau_system.squeeze().tolist())
+                tau_tracker.append(self.rnn_cell.last_tau_system.squeeze().tolist())
 
             if self.return_sequences:
                 output_sequence.append(self.fc(h_out))
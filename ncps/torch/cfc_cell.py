@@ -24,13 +24,102 @@ import torch.nn.functional as F
 from typing import Optional, Union
 
 
+@torch.jit.script
+def lecun_tanh(x: torch.Tensor) -> torch.Tensor:
+    return 1.7159 * torch.tanh(0.666 * x)
+
+
 class LeCun(nn.Module):
     def __init__(self):
         super(LeCun, self).__init__()
-        self.tanh = nn.Tanh()
 
     def forward(self, x):
-        return 1.7159 * self.tanh(0.666 * x)
+        return lecun_tanh(x)
+
+
+@torch.jit.script
+def _upcast(x: torch.Tensor) -> torch.Tensor:
+    # Reduced precision activations (e.g., under autocast) are evaluated in
+    # fp32 so that exp and the interpolation do not lose range or precision
+    if x.dtype == torch.float16 or x.dtype == torch.bfloat16:
+        return x.float()
+    return x
+
+
+# The per-step arithmetic of each mode lives in scripted free functions so
+# that the TorchScript fuser can merge the elementwise chain into a single
+# kernel instead of launching one kernel per operator.
+@torch.jit.script
+def _cfc_default_step(
+    ff1: torch.Tensor,
+    ff2: torch.Tensor,
+    t_a: torch.Tensor,
+    t_b: torch.Tensor,
+    ts: torch.Tensor,
+) -> torch.Tensor:
+    ff1, ff2 = _upcast(ff1), _upcast(ff2)
+    t_a, t_b = _upcast(t_a), _upcast(t_b)
+    t_interp = torch.addcmul(t_b, t_a, ts.to(t_a.dtype)).sigmoid_()
+    # lerp computes ff1 * (1 - t_interp) + t_interp * ff2
+    return torch.lerp(ff1, ff2, t_interp)
+
+
+@torch.jit.script
+def _cfc_no_gate_step(
+    ff1: torch.Tensor,
+    ff2: torch.Tensor,
+    t_a: torch.Tensor,
+    t_b: torch.Tensor,
+    ts: torch.Tensor,
+) -> torch.Tensor:
+    ff1, ff2 = _upcast(ff1), _upcast(ff2)
+    t_a, t_b = _upcast(t_a), _upcast(t_b)
+    t_interp = torch.addcmul(t_b, t_a, ts.to(t_a.dtype)).sigmoid_()
+    return torch.addcmul(ff1, t_interp, ff2)
+
+
+@torch.jit.script
+def _cfc_closed_form_step(
+    ff1: torch.Tensor, denom: torch.Tensor, A: torch.Tensor, ts: torch.Tensor
+) -> torch.Tensor:
+    return -A * torch.exp(-_upcast(ts) * _upcast(denom)) * _upcast(ff1) + A
+
+
+def _get_activation(name):
+    if name == "silu":
+        return nn.SiLU
+    elif name == "relu":
+        return nn.ReLU
+    elif name == "tanh":
+        return nn.Tanh
+    elif name == "gelu":
+        return nn.GELU
+    elif name == "lecun_tanh":
+        return LeCun
+    raise ValueError(f"Unknown activation {name}")
+
+
+def _is_compiling():
+    compiler = getattr(torch, "compiler", None)
+    return getattr(compiler, "is_compiling", lambda: False)()
+
+
+def _is_autocast_enabled():
+    # Whether autocast is active for any device type
+    for device_type in ("cuda", "cpu", "xpu", "mps", "hpu"):
+        try:
+            if torch.is_autocast_enabled(device_type):
+                return True
+        except TypeError:
+            # Before torch 2.4 each device type has its own query function
+            return torch.is_autocast_enabled() or any(
+                getattr(torch, f"is_autocast_{name}_enabled", lambda: False)()
+                for name in ("cpu", "xpu", "hpu")
+            )
+        except RuntimeError:
+            # Device type without autocast support in this build
+            continue
+    return False
 
 
 class CfCCell(nn.Module):
@@ -44,6 +133,7 @@ class CfCCell(nn.Module):
         backbone_layers=1,
         backbone_dropout=0.0,
         sparsity_mask=None,
+        pad_hidden_to=1,
     ):
         """A `Closed-form Continuous-time <https://arxiv.org/abs/2106.13898>`_ cell.
 
@@ -60,40 +150,33 @@ class CfCCell(nn.Module):
         :param backbone_layers:
         :param backbone_dropout:
         :param sparsity_mask:
+        :param pad_hidden_to: Pads the hidden dimension of the internal weights and activations to a multiple of this value (e.g., 8 or 16) so that GEMM and elementwise kernels run on full SIMD/Tensor Core tiles. The returned state still has hidden_size units.
         """
 
         super(CfCCell, self).__init__()
 
         self.input_size = input_size
         self.hidden_size = hidden_size
+        if pad_hidden_to < 1:
+            raise ValueError(f"pad_hidden_to must be at least 1 (got {pad_hidden_to})")
+        self._h_padded = -(-hidden_size // pad_hidden_to) * pad_hidden_to
         allowed_modes = ["default", "pure", "no_gate", "neuromodulated", "only_neuromodulated"]
         if mode not in allowed_modes:
             raise ValueError(
                 f"Unknown mode '{mode}', valid options are {str(allowed_modes)}"
             )
-        self.sparsity_mask = (
+        # The mask is a fixed boolean buffer rather than a frozen Parameter, so
+        # that it stays out of .parameters() and optimizers.
+        self.register_buffer(
+            "sparsity_mask",
             None
             if sparsity_mask is None
-            else torch.nn.Parameter(
-                data=torch.from_numpy(np.abs(sparsity_mask.T).astype(np.float32)),
-                requires_grad=False,
-            )
+            else torch.from_numpy(np.abs(sparsity_mask.T) > 0),
         )
 
         self.mode = mode
 
-        if backbone_activation == "silu":
-            backbone_activation = nn.SiLU
-        elif backbone_activation == "relu":
-            backbone_activation = nn.ReLU
-        elif backbone_activation == "tanh":
-            backbone_activation = nn.Tanh
-        elif backbone_activation == "gelu":
-            backbone_activation = nn.GELU
-        elif backbone_activation == "lecun_tanh":
-            backbone_activation = LeCun
-        else:
-            raise ValueError(f"Unknown activation {backbone_activation}")
+        backbone_activation = _get_activation(backbone_activation)
 
         self.backbone = None
         self.backbone_layers = backbone_layers
@@ -108,119 +191,547 @@ class CfCCell(nn.Module):
                 if backbone_dropout > 0.0:
                     layer_list.append(torch.nn.Dropout(backbone_dropout))
             self.backbone = nn.Sequential(*layer_list)
-        self.tanh = nn.Tanh()
-        self.sigmoid = nn.Sigmoid()
         cat_shape = int(
             self.hidden_size + input_size if backbone_layers == 0 else backbone_units
         )
 
-        self.ff1 = nn.Linear(cat_shape, hidden_size)
-        if self.mode == "pure" or self.mode == "neuromodulated" or self.mode == "only_neuromodulated":
+        self._closed_form = self.mode in ("pure", "neuromodulated", "only_neuromodulated")
+        if self._closed_form:
+            self.ff1 = nn.Linear(cat_shape, self._h_padded)
             self.w_tau = torch.nn.Parameter(
-                data=torch.zeros(1, self.hidden_size), requires_grad=True
+                data=torch.zeros(1, self._h_padded), requires_grad=True
             )
             self.A = torch.nn.Parameter(
-                data=torch.ones(1, self.hidden_size), requires_grad=True
+                data=torch.ones(1, self._h_padded), requires_grad=True
             )
-
-            
         else:
-            self.ff2 = nn.Linear(cat_shape, hidden_size)
-            self.time_a = nn.Linear(cat_shape, hidden_size)
-            self.time_b = nn.Linear(cat_shape, hidden_size)
+            # ff1, ff2, time_a and time_b share the same input, so they are
+            # computed by a single projection and split afterwards.
+            self.ff = nn.Linear(cat_shape, 4 * self._h_padded)
+
+        # Masks sparser than this threshold are applied at inference time
+        # by a sparse CSR matmul instead of a dense masked one.
+        self.sparse_density_threshold = 0.1
+        # Masks sparser than this threshold (but too dense for the CSR path,
+        # or while training) only gather the unmasked weights and
+        # scatter-add their contributions into the output.
+        self.scatter_density_threshold = 0.2
+        # Inference-time caches of the masked projection weight, see
+        # refresh_masked_weights. Sparse masks only cache the unmasked values.
+        self.register_buffer("_ff_masked_weight", None, persistent=False)
+        self.register_buffer("_ff_masked_values", None, persistent=False)
+        self._ff_masked_weight_key = None
+        self._ff_weight_csr = None
+        # Projection mask and its nonzero indices (also in CSR layout),
+        # derived from sparsity_mask
+        self.register_buffer("_ff_mask", None, persistent=False)
+        self.register_buffer("_ff_rows", None, persistent=False)
+        self.register_buffer("_ff_cols", None, persistent=False)
+        self.register_buffer("_ff_crow", None, persistent=False)
+        self._rebuild_mask_state()
+        # Set by quantize_for_inference
+        self._quantized = False
+        # Scratch buffers holding the concatenation of input and hidden state
+        # and the output of the input projection
+        self._xbuf = None
+        self._ff_out = None
+        # 0-dim tensor holding the last Python float time span
+        self._ts_tensor = None
+        self._ts_key = None
 
         # Create a vector to store tau system values. It is just for
-        # storing calculated values, these values aren't learned.
-        self.tau_system = torch.nn.Parameter(
-            torch.ones((self.hidden_size,)), requires_grad=False
-        )
+        # storing calculated values, these values aren't learned. It is
+        # resized in-place to the shape of the last step, e.g. (B,H).
+        self.register_buffer("tau_system", torch.ones((self.hidden_size,)), persistent=False)
+
+        # tau_system is only updated when requested since computing it costs
+        # an extra division and allocation per step.
+        self.record_tau_system = False
+
+        # When enabled, the step is compiled with torch.compile on the first
+        # call and replayed as a fused kernel (and CUDA graph) afterwards.
+        self.use_compile = False
+        self._compiled = None
 
         self.init_weights()
 
     def init_weights(self):
-        for w in self.parameters():
-            if w.dim() == 2 and w.requires_grad:
-                torch.nn.init.xavier_uniform_(w)
-    
+        # The real hidden_size units are initialized as in an unpadded cell.
+        # Padded units get zero weights and biases, w_tau = 0 and A = 1.
+        hidden_size = self.hidden_size
+        with torch.no_grad():
+            for name, w in self.named_parameters():
+                if name == "ff.weight":
+                    # The fused projection holds the four (H, cat) blocks of
+                    # ff1, ff2, time_a and time_b, each initialized like a
+                    # separate layer so that the fan-out is H rather than 4H
+                    for block in w.view(4, self._h_padded, -1):
+                        torch.nn.init.xavier_uniform_(block[:hidden_size])
+                        block[hidden_size:].zero_()
+                elif name == "ff.bias":
+                    w.view(4, self._h_padded)[:, hidden_size:].zero_()
+                elif name == "ff1.weight":
+                    torch.nn.init.xavier_uniform_(w[:hidden_size])
+                    w[hidden_size:].zero_()
+                elif name == "ff1.bias":
+                    w[hidden_size:].zero_()
+                elif name in ("w_tau", "A"):
+                    torch.nn.init.xavier_uniform_(w[:, :hidden_size])
+                    w[:, hidden_size:].fill_(0.0 if name == "w_tau" else 1.0)
+                elif w.dim() == 2 and w.requires_grad:
+                    torch.nn.init.xavier_uniform_(w)
 
+    @property
+    def last_tau_system(self):
+        """A copy of the tau system values of the last step (only updated if ``record_tau_system`` is set)"""
+        # The buffer itself is resized and overwritten by the next step
+        return self.tau_system.clone()
 
-    def forward(self, input, hx, ts, neuromod_signal=None):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # tau_system used to be stored as a frozen Parameter
+        state_dict.pop(prefix + "tau_system", None)
+        # Checkpoints written before the gate projections were fused store
+        # ff1, ff2, time_a and time_b as separate layers.
+        if not self._closed_form and prefix + "ff1.weight" in state_dict:
+            for suffix in ("weight", "bias"):
+                state_dict[prefix + "ff." + suffix] = torch.cat(
+                    [
+                        state_dict.pop(f"{prefix}{name}.{suffix}")
+                        for name in ("ff1", "ff2", "time_a", "time_b")
+                    ],
+                    0,
+                )
+        super(CfCCell, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        # The loaded sparsity_mask replaces the one everything else was
+        # derived from
+        self._rebuild_mask_state()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The compiled step wraps a method bound to this instance. A copy
+        # would keep calling the original cell, and the closure cannot be
+        # pickled, so copies compile their own step on first use.
+        state["_compiled"] = None
+        return state
+
+    def _apply(self, fn, *args, **kwargs):
+        module = super(CfCCell, self)._apply(fn, *args, **kwargs)
+        # Moved or converted weights may reuse the storage of the old ones
+        self._ff_masked_weight_key = None
+        self._ff_weight_csr = None
+        return module
+
+    def _rebuild_mask_state(self):
+        # Mask matching the weight of the input projection. In the gated modes
+        # only the ff1 and ff2 blocks are sparse, the time gates stay dense.
+        # Padded units are masked out entirely.
+        self._ff_masked_weight = None
+        self._ff_masked_values = None
+        self._ff_masked_weight_key = None
+        self._ff_weight_csr = None
+        self._ff_sparse_rows = self._h_padded if self._closed_form else 2 * self._h_padded
+        if self.sparsity_mask is None:
+            self._ff_mask = None
+            self._ff_mask_density = 1.0
+            return
+        mask = self.sparsity_mask.bool()
+        if self._h_padded != self.hidden_size:
+            padding = mask.new_zeros((self._h_padded - self.hidden_size, mask.shape[1]))
+            mask = torch.cat([mask, padding], 0)
+        if not self._closed_form:
+            dense = torch.ones_like(mask)
+            mask = torch.cat([mask, mask, dense, dense], 0)
+        self._ff_mask = mask
+        # The sparse paths only cover the leading masked rows (ff1, and ff2 in
+        # the gated modes). The dense time gate rows always use a dense GEMM.
+        sparse_mask = mask[: self._ff_sparse_rows]
+        self._ff_mask_density = float(sparse_mask.float().mean())
+        self._ff_rows, self._ff_cols = sparse_mask.nonzero(as_tuple=True)
+        # nonzero is row-major, so the indices are already sorted as CSR needs
+        counts = torch.bincount(self._ff_rows, minlength=self._ff_sparse_rows)
+        self._ff_crow = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+
+    def quantize_for_inference(self):
+        """Replaces the input projection by a dynamically quantized int8 layer.
+
+        The weights are stored in int8 and the matmul runs on the int8 CPU
+        kernels (FBGEMM/QNNPACK). The sparsity mask is applied to the
+        weight before quantization. The backbone, ``w_tau`` and ``A`` stay
+        in floating point. The cell must be on the CPU and can no longer be
+        trained afterwards.
+
+        :return: The cell itself
+        """
+        if self._quantized:
+            return self
+        name = "ff1" if self._closed_form else "ff"
+        layer = getattr(self, name)
+        float_layer = nn.Linear(layer.in_features, layer.out_features)
+        with torch.no_grad():
+            weight = layer.weight
+            if self._ff_mask is not None:
+                weight = torch.where(self._ff_mask, weight, 0.0)
+            float_layer.weight.copy_(weight)
+            float_layer.bias.copy_(layer.bias)
+        float_layer.qconfig = torch.ao.quantization.default_dynamic_qconfig
+        setattr(self, name, torch.ao.nn.quantized.dynamic.Linear.from_float(float_layer))
+        self._quantized = True
+        # A compiled step would still run the float projection
+        self._compiled = None
+        return self
+
+    def fuse_for_inference(self):
+        """Folds the last backbone layer into the input projection.
+
+        Two consecutive linear layers collapse into one with weight
+        ``W_ff @ W_last`` and bias ``W_ff @ b_last + b_ff``, which saves a
+        matmul per step. This is only valid if nothing non-linear follows the
+        last backbone ``nn.Linear``, e.g., after its activation has been
+        replaced by ``nn.Identity``. Trailing ``nn.Dropout`` layers are
+        dropped, so the fused cell is meant for inference only.
+
+        :return: The cell itself
+        """
+        if self.backbone is None:
+            raise ValueError("The cell has no backbone layer that could be fused")
+        if self._quantized or self._ff_mask is not None:
+            raise ValueError(
+                "Cannot fuse the backbone of a quantized or sparsity masked cell"
+            )
+        modules = list(self.backbone)
+        while modules and isinstance(modules[-1], (nn.Identity, nn.Dropout)):
+            modules.pop()
+        if not modules or not isinstance(modules[-1], nn.Linear):
+            raise ValueError(
+                "The last backbone layer is followed by a non-linear activation and cannot be fused"
+            )
+        last = modules.pop()
+
+        name = "ff1" if self._closed_form else "ff"
+        layer = getattr(self, name)
+        fused = nn.Linear(last.in_features, layer.out_features).to(
+            device=layer.weight.device, dtype=layer.weight.dtype
+        )
+        with torch.no_grad():
+            fused.weight.copy_(layer.weight @ last.weight)
+            fused.bias.copy_(layer.weight @ last.bias + layer.bias)
+        setattr(self, name, fused)
+
+        if modules:
+            self.backbone = nn.Sequential(*modules)
+        else:
+            self.backbone = None
+            self.backbone_layers = 0
+        self._compiled = None
+        return self
+
+    def _use_inference_caches(self):
+        # Cached weights and out= buffers are not part of the autograd graph,
+        # are invisible to torch.compile and bypass autocast's dtype
+        # selection, so they are only used in plain eager inference.
+        return (
+            not torch.is_grad_enabled()
+            and not _is_compiling()
+            and not _is_autocast_enabled()
+        )
+
+    def _masked_weight_key(self, layer):
+        # Changes when the weight or the mask is modified in-place through
+        # autograd-visible ops, e.g. by an optimizer step. Writes through
+        # .data bypass the version counter and need refresh_masked_weights.
+        return (layer.weight.data_ptr(), layer.weight._version, self._ff_mask._version)
+
+    def refresh_masked_weights(self):
+        """Recomputes the cached masked weight used by inference steps.
+
+        No-grad steps reuse a copy of the masked projection weight, or only
+        of its unmasked values if the mask is sparse enough for the CSR or
+        scatter-add path. The cache is rebuilt automatically after optimizer steps,
+        ``load_state_dict`` and device or dtype moves. Call this method after
+        modifying the projection weight in a way that autograd cannot see,
+        e.g. through ``weight.data``.
+        """
+        if self._ff_mask is None or self._quantized:
+            return
+        layer = self.ff1 if self._closed_form else self.ff
+        with torch.no_grad():
+            if self._uses_sparse_cache():
+                # Only the unmasked values are kept, not a dense copy
+                self._ff_masked_weight = None
+                self._ff_masked_values = layer.weight[self._ff_rows, self._ff_cols]
+            else:
+                self._ff_masked_weight = torch.where(self._ff_mask, layer.weight, 0.0)
+                self._ff_masked_values = None
+        self._ff_masked_weight_key = self._masked_weight_key(layer)
+        self._ff_weight_csr = None
+
+    def _uses_sparse_cache(self):
+        # Whether inference steps take the CSR or the scatter-add path
+        return self._ff_mask_density < max(
+            self.sparse_density_threshold, self.scatter_density_threshold
+        )
+
+    def _scratch(self, name, rows, cols, dtype, device):
+        buf = getattr(self, name)
+        if (
+            buf is None
+            or buf.shape[0] < rows
+            or buf.shape[1] != cols
+            or buf.dtype != dtype
+            or buf.device != device
+            or buf.is_inference() != torch.is_inference_mode_enabled()
+        ):
+            buf = torch.empty((rows, cols), dtype=dtype, device=device)
+            setattr(self, name, buf)
+        return buf[:rows]
+
+    def _concat(self, input, hx, use_caches):
+        # copy_ would broadcast a hidden state of the wrong batch size, so
+        # those are left to torch.cat to reject
+        if (
+            not use_caches
+            or input.dim() != 2
+            or hx.dim() != 2
+            or hx.shape[0] != input.shape[0]
+        ):
+            return torch.cat([input, hx], 1)
+        batch_size, input_size = input.shape
+        buf = self._scratch(
+            "_xbuf",
+            batch_size,
+            input_size + hx.shape[1],
+            torch.result_type(input, hx),
+            input.device,
+        )
+        buf[:, :input_size].copy_(input)
+        buf[:, input_size:].copy_(hx)
+        return buf
+
+    def _time_span(self, ts, dtype, device):
+        # Python float time spans are turned into a cached 0-dim tensor, so
+        # that a constant ts does not cost a fill kernel on every step
+        if _is_compiling():
+            return torch.full((), ts, dtype=dtype, device=device)
+        key = (ts, dtype, device, torch.is_inference_mode_enabled())
+        if self._ts_key != key:
+            self._ts_tensor = torch.full((), ts, dtype=dtype, device=device)
+            self._ts_key = key
+        return self._ts_tensor
+
+    def _linear(self, x, weight, bias, use_caches):
+        if not use_caches:
+            return F.linear(x, weight, bias)
+        out = self._scratch("_ff_out", x.shape[0], weight.shape[0], x.dtype, x.device)
+        return torch.addmm(bias, x, weight.t(), out=out)
+
+    def _scatter_linear(self, layer, x, values):
+        contributions = x.index_select(1, self._ff_cols) * values
+        out = layer.bias[: self._ff_sparse_rows].unsqueeze(0).repeat(x.shape[0], 1)
+        return out.index_add_(1, self._ff_rows, contributions)
+
+    def _with_dense_rows(self, sparse_out, x, layer):
+        # Appends the unmasked time gate rows of the gated modes
+        rows = self._ff_sparse_rows
+        if rows == layer.out_features:
+            return sparse_out
+        dense_out = F.linear(x, layer.weight[rows:], layer.bias[rows:])
+        return torch.cat([sparse_out, dense_out], 1)
+
+    def _project(self, x, use_caches):
+        layer = self.ff1 if self._closed_form else self.ff
+        if self._quantized:
+            # The mask is already folded into the quantized weight
+            return layer(x)
+        if self._ff_mask is None:
+            return self._linear(x, layer.weight, layer.bias, use_caches)
+        if use_caches:
+            sparse = self._uses_sparse_cache()
+            cached = self._ff_masked_values if sparse else self._ff_masked_weight
+            if cached is None or self._ff_masked_weight_key != self._masked_weight_key(layer):
+                self.refresh_masked_weights()
+            if not sparse:
+                return self._linear(x, self._ff_masked_weight, layer.bias, use_caches)
+            rows = self._ff_sparse_rows
+            if self._ff_mask_density < self.sparse_density_threshold:
+                if self._ff_weight_csr is None:
+                    # Shares its values with the cache
+                    self._ff_weight_csr = torch.sparse_csr_tensor(
+                        self._ff_crow,
+                        self._ff_cols,
+                        self._ff_masked_values,
+                        (rows, layer.in_features),
+                    )
+                sparse_out = torch.mm(self._ff_weight_csr, x.t()).t() + layer.bias[:rows]
+            else:
+                sparse_out = self._scatter_linear(layer, x, self._ff_masked_values)
+            return self._with_dense_rows(sparse_out, x, layer)
+        if self._ff_mask_density < self.scatter_density_threshold:
+            values = layer.weight[self._ff_rows, self._ff_cols]
+            return self._with_dense_rows(self._scatter_linear(layer, x, values), x, layer)
+        return F.linear(x, torch.where(self._ff_mask, layer.weight, 0.0), layer.bias)
+
+
+    def check_neuromod_signal(self, neuromod_signal):
+        """Validates a neuromodulation signal for this cell.
+
+        ``forward`` runs this check on every step unless Python is started
+        with ``-O``. Callers that keep the same signal for many steps can call
+        it once up front and run optimized.
+
+        :param neuromod_signal: Neuromodulation signal passed to ``forward``
+        """
         # If neuromodulation is used, the neuromodulation signal must be provided
         if self.mode == "neuromodulated" or self.mode == "only_neuromodulated":
             assert neuromod_signal is not None, "Neuromodulation signal must be provided"
-        
-        x = torch.cat([input, hx], 1)
+        if self.mode == "neuromodulated":
+            try:
+                torch.broadcast_tensors(neuromod_signal, self.w_tau[:, : self.hidden_size])
+            except Exception as e:
+                raise AssertionError("Neuromodulation signal and w_tau are not broadcastable")
+
+    def forward(self, input, hx, ts, neuromod_signal=None):
+        """
+
+        :param input: Input tensor of shape (B,C)
+        :param hx: Hidden state of shape (B,H)
+        :param ts: Time span of the step, either a scalar or a tensor broadcastable to (B,H)
+        :param neuromod_signal: Neuromodulation signal broadcastable to (B,H), required in the neuromodulated modes
+        :return: A pair (output, hx) that both hold the new hidden state
+
+        The step can run under ``torch.autocast``, in which case ``input``,
+        ``hx`` and ``ts`` may be bf16. The projections then run in bf16 while
+        the closed-form solution and the gate interpolation are evaluated in
+        fp32, and the new state is returned in the dtype of ``hx``. The
+        parameters ``w_tau`` and ``A`` and the recorded ``tau_system`` stay in
+        fp32.
+        """
+        # Argument checks are skipped when Python runs with -O
+        if __debug__:
+            self.check_neuromod_signal(neuromod_signal)
+
+        if self.use_compile:
+            if self._compiled is None:
+                self._compiled = torch.compile(
+                    self._forward_impl,
+                    fullgraph=True,
+                    dynamic=False,
+                    mode="reduce-overhead",
+                )
+            new_hidden, denom = self._compiled(input, hx, ts, neuromod_signal)
+            # Outputs of a CUDA graph replay are overwritten by the next replay
+            new_hidden = new_hidden.clone()
+        else:
+            new_hidden, denom = self._forward_impl(input, hx, ts, neuromod_signal)
+
+        if denom is not None:
+            # Written in-place so that recording does not allocate per step
+            if self.tau_system.shape != denom.shape:
+                self.tau_system.resize_(denom.shape)
+            torch.reciprocal(denom.detach(), out=self.tau_system)
+        return new_hidden, new_hidden
 
+    def teacher_forced_step(self, input_seq, hx_seq, ts_seq=1.0):
+        """Evaluates a "pure" mode step for every time step of a sequence at once.
+
+        This does not run the recurrence: each step starts from the hidden
+        state given in ``hx_seq`` rather than from the output of the previous
+        step. If these states are already known (e.g., recorded rollouts or
+        teacher forcing), all steps are independent and are computed by one
+        batched projection and a single fused elementwise kernel instead of
+        one launch sequence per step. Passing a broadcast initial state
+        instead gives different results than running :meth:`forward` in a
+        loop.
+
+        Unlike :meth:`forward`, this method does not record ``tau_system``,
+        even if ``record_tau_system`` is set.
+
+        :param input_seq: Inputs of shape (B,T,C)
+        :param hx_seq: Hidden states preceding each step of shape (B,T,H)
+        :param ts_seq: Time spans of shape (B,T) or a scalar
+        :return: The new hidden states of shape (B,T,H)
+        """
+        if self.mode != "pure":
+            raise ValueError(
+                f"teacher_forced_step requires mode 'pure' (got '{self.mode}')"
+            )
+        batch_size, seq_len = input_seq.shape[:2]
+        x = torch.cat([input_seq, hx_seq], 2).reshape(batch_size * seq_len, -1)
         if self.backbone_layers > 0:
             x = self.backbone(x)
-        
-        if self.sparsity_mask is not None:
-            ff1 = F.linear(x, self.ff1.weight * self.sparsity_mask, self.ff1.bias)
-        else:
-            ff1 = self.ff1(x)
-        
-        if self.mode == "pure":
-            # Solution
-            new_hidden = (
-                -self.A
-                * torch.exp(-ts * (torch.abs(self.w_tau) + torch.abs(ff1)))
-                * ff1
-                + self.A
+        # Without the inference caches, so that the (B*T)-row projection does
+        # not grow the per-step scratch buffers
+        ff1 = self._project(x, False).reshape(batch_size, seq_len, -1)
+
+        if not isinstance(ts_seq, torch.Tensor):
+            ts_seq = self._time_span(
+                ts_seq, torch.promote_types(ff1.dtype, torch.float32), ff1.device
             )
+        elif ts_seq.dim() == 2:
+            ts_seq = ts_seq.unsqueeze(-1)
 
-            # This calculation of the tau system seems to be in accordance
-            # with equations 1, 2, and 3 in "Closed-form Continuous-time
-            # Neural Networks".
-            self.tau_system.data = 1.0 / (torch.abs(self.w_tau) + torch.abs(ff1))
-        elif self.mode == "neuromodulated":
-            try:
-                torch.broadcast_tensors(neuromod_signal, self.w_tau)
-            except Exception as e:
-                raise AssertionError("Neuromodulation signal and w_tau are not broadcastable")
+        denom = torch.abs(self.w_tau) + torch.abs(ff1)
+        new_hidden = _cfc_closed_form_step(ff1, denom, self.A, ts_seq)
+        return self._unpad(new_hidden).to(hx_seq.dtype).contiguous()
 
+    def _unpad(self, x):
+        if self._h_padded == self.hidden_size:
+            return x
+        return x[..., : self.hidden_size]
 
-            new_hidden = (
-                -self.A
-                * torch.exp(-ts * (torch.abs(self.w_tau) + torch.abs(neuromod_signal)))
-                * ff1
-                + self.A
-            )
+    def _forward_impl(self, input, hx, ts, neuromod_signal):
+        # Evaluated once per step and passed down to the helpers
+        use_caches = self._use_inference_caches()
+        x = self._concat(input, hx, use_caches)
+
+        if self.backbone_layers > 0:
+            x = self.backbone(x)
+        
+        if self._closed_form:
+            ff1 = self._project(x, use_caches)
+        else:
+            ff1, ff2, t_a, t_b = self._project(x, use_caches).chunk(4, 1)
 
-            # This calculation of the tau system seems to be in accordance
-            # with equations 1, 2, and 3 in "Closed-form Continuous-time
-            # Neural Networks".
-            self.tau_system.data = 1.0 / (torch.abs(self.w_tau) + torch.abs(neuromod_signal))
-        elif self.mode == "only_neuromodulated":
-            # try:
-            #     torch.broadcast_tensors(neuromod_signal, self.w_tau)
-            # except Exception as e:
-            #     raise AssertionError("Neuromodulation signal and w_tau are not broadcastable")
-
-
-            new_hidden = (
-                -self.A
-                * torch.exp(-ts * (torch.abs(neuromod_signal)))
-                * ff1
-                + self.A
+        if not isinstance(ts, torch.Tensor):
+            ts = self._time_span(
+                ts, torch.promote_types(ff1.dtype, torch.float32), ff1.device
             )
 
-            # This calculation of the tau system seems to be in accordance
-            # with equations 1, 2, and 3 in "Closed-form Continuous-time
-            # Neural Networks".
-            self.tau_system.data = 1.0 / (torch.abs(neuromod_signal))
+        tau_denom = None
+        if self._closed_form:
+            if (
+                neuromod_signal is not None
+                and self._h_padded != self.hidden_size
+                and neuromod_signal.dim() > 0
+                and neuromod_signal.shape[-1] == self.hidden_size
+            ):
+                neuromod_signal = F.pad(
+                    neuromod_signal, (0, self._h_padded - self.hidden_size)
+                )
+
+            # The denominator is shared by the solution and the tau system
+            if self.mode == "pure":
+                denom = torch.abs(self.w_tau) + torch.abs(ff1)
+            elif self.mode == "neuromodulated":
+                denom = torch.abs(self.w_tau) + torch.abs(neuromod_signal)
+            else:
+                denom = torch.abs(neuromod_signal)
+
+            # Solution
+            new_hidden = _cfc_closed_form_step(ff1, denom, self.A, ts)
+
+            # The tau system is the reciprocal of the denominator, which seems
+            # to be in accordance with equations 1, 2, and 3 in "Closed-form
+            # Continuous-time Neural Networks". forward stores it.
+            if self.record_tau_system:
+                tau_denom = self._unpad(denom)
         else:
             # Cfc
-            if self.sparsity_mask is not None:
-                ff2 = F.linear(x, self.ff2.weight * self.sparsity_mask, self.ff2.bias)
-            else:
-                ff2 = self.ff2(x)
-            ff1 = self.tanh(ff1)
-            ff2 = self.tanh(ff2)
-            t_a = self.time_a(x)
-            t_b = self.time_b(x)
-            t_interp = self.sigmoid(t_a * ts + t_b)
+            ff1 = torch.tanh(ff1)
+            ff2 = torch.tanh(ff2)
             if self.mode == "no_gate":
-                new_hidden = ff1 + t_interp * ff2
+                new_hidden = _cfc_no_gate_step(ff1, ff2, t_a, t_b, ts)
             else:
-                new_hidden = ff1 * (1.0 - t_interp) + t_interp * ff2
-        return new_hidden, new_hidden
\ No newline at end of file
+                new_hidden = _cfc_default_step(ff1, ff2, t_a, t_b, ts)
+        # The state keeps the dtype it was passed in, independent of autocast.
+        # contiguous() keeps a padded state from holding on to the padding.
+        return self._unpad(new_hidden).to(hx.dtype).contiguous(), tau_denom
\ No newline at end of file
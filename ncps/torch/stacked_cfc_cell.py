@@ -0,0 +1,155 @@
+# Copyright 2022 Mathias Lechner and Ramin Hasani
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from .cfc_cell import (
+    _cfc_closed_form_step,
+    _cfc_default_step,
+    _cfc_no_gate_step,
+    _get_activation,
+)
+
+
+class StackedCfCCell(nn.Module):
+    def __init__(
+        self,
+        n_cells,
+        input_size,
+        hidden_size,
+        mode="default",
+        backbone_activation="lecun_tanh",
+        backbone_units=128,
+        backbone_layers=1,
+        backbone_dropout=0.0,
+    ):
+        """A group of independent `Closed-form Continuous-time <https://arxiv.org/abs/2106.13898>`_ cells evaluated together.
+
+        Each of the ``n_cells`` cells behaves like a separate :class:`CfCCell`
+        (e.g., the members of an ensemble or per-agent policies), but the
+        parameters of all cells are packed into batched tensors with a
+        leading cell dimension. A step then runs one batched matmul per layer
+        for all cells instead of one small matmul per cell.
+
+        Examples::
+
+             >>> from ncps.torch import StackedCfCCell
+             >>>
+             >>> cells = StackedCfCCell(4, 20, 50)
+             >>> x = torch.randn(4, 2, 20) # (cells, batch, features)
+             >>> h = torch.zeros(4, 2, 50) # (cells, batch, units)
+             >>> output, h = cells(x, h, 1.0)
+
+        :param n_cells: Number of independent cells
+        :param input_size: Number of input features of each cell
+        :param hidden_size: Number of hidden units of each cell
+        :param mode: Either "default", "pure" (direct solution approximation), or "no_gate" (without second gate)
+        :param backbone_activation: Activation function used in the backbone layers
+        :param backbone_units: Number of hidden units in the backbone layers
+        :param backbone_layers: Number of backbone layers
+        :param backbone_dropout: Dropout rate in the backbone layers
+        """
+        super(StackedCfCCell, self).__init__()
+
+        self.n_cells = n_cells
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        allowed_modes = ["default", "pure", "no_gate"]
+        if mode not in allowed_modes:
+            raise ValueError(
+                f"Unknown mode '{mode}', valid options are {str(allowed_modes)}"
+            )
+        self.mode = mode
+        self.backbone_activation = _get_activation(backbone_activation)()
+        self.backbone_dropout = backbone_dropout
+
+        # Layer i of cell n uses backbone_weight[i][n] and backbone_bias[i][n]
+        self.backbone_weight = nn.ParameterList()
+        self.backbone_bias = nn.ParameterList()
+        in_features = input_size + hidden_size
+        for i in range(backbone_layers):
+            self.backbone_weight.append(
+                nn.Parameter(torch.empty(n_cells, backbone_units, in_features))
+            )
+            self.backbone_bias.append(nn.Parameter(torch.empty(n_cells, backbone_units)))
+            in_features = backbone_units
+
+        out_features = hidden_size if mode == "pure" else 4 * hidden_size
+        self.ff_weight = nn.Parameter(torch.empty(n_cells, out_features, in_features))
+        self.ff_bias = nn.Parameter(torch.empty(n_cells, out_features))
+        if mode == "pure":
+            self.w_tau = nn.Parameter(torch.zeros(n_cells, 1, hidden_size))
+            self.A = nn.Parameter(torch.ones(n_cells, 1, hidden_size))
+
+        self.init_weights()
+
+    def init_weights(self):
+        # Same initialization as n separate CfCCells: nn.Linear's default
+        # bias, and xavier_uniform_ on every 2-D weight of each cell
+        for w, b in zip(
+            list(self.backbone_weight) + [self.ff_weight],
+            list(self.backbone_bias) + [self.ff_bias],
+        ):
+            bound = 1 / math.sqrt(w.shape[2])
+            torch.nn.init.uniform_(b, -bound, bound)
+        with torch.no_grad():
+            for w in self.parameters():
+                if w.dim() != 3:
+                    continue
+                if w is self.ff_weight and self.mode != "pure":
+                    # ff1, ff2, time_a and time_b are initialized as separate
+                    # (H, C) layers, as in CfCCell
+                    w = w.view(self.n_cells * 4, self.hidden_size, -1)
+                for cell_w in w:
+                    torch.nn.init.xavier_uniform_(cell_w)
+
+    def forward(self, input, hx, ts):
+        """
+
+        :param input: Input tensor of shape (N,B,C)
+        :param hx: Hidden states of shape (N,B,H)
+        :param ts: Time span of the step, either a scalar or a tensor broadcastable to (N,B,H)
+        :return: A pair (output, hx) that both hold the new hidden states
+        """
+        x = torch.cat([input, hx], 2)
+        for i, (w, b) in enumerate(zip(self.backbone_weight, self.backbone_bias)):
+            x = self.backbone_activation(
+                torch.baddbmm(b.unsqueeze(1), x, w.transpose(1, 2))
+            )
+            if i > 0 and self.backbone_dropout > 0.0:
+                x = F.dropout(x, self.backbone_dropout, self.training)
+        gates = torch.baddbmm(self.ff_bias.unsqueeze(1), x, self.ff_weight.transpose(1, 2))
+
+        if not isinstance(ts, torch.Tensor):
+            ts = torch.full(
+                (), ts, dtype=torch.promote_types(gates.dtype, torch.float32), device=gates.device
+            )
+
+        if self.mode == "pure":
+            denom = torch.abs(self.w_tau) + torch.abs(gates)
+            new_hidden = _cfc_closed_form_step(gates, denom, self.A, ts)
+        else:
+            ff1, ff2, t_a, t_b = gates.chunk(4, 2)
+            ff1 = torch.tanh(ff1)
+            ff2 = torch.tanh(ff2)
+            if self.mode == "no_gate":
+                new_hidden = _cfc_no_gate_step(ff1, ff2, t_a, t_b, ts)
+            else:
+                new_hidden = _cfc_default_step(ff1, ff2, t_a, t_b, ts)
+        new_hidden = new_hidden.to(hx.dtype)
+        return new_hidden, new_hidden